@@ -2,12 +2,24 @@
 from .models import GBM
 from .models import GaussianCopula
 from .models import TCopula
+from .models import HistoricalSimulation
 
 from .analysis import Analysis
+from .analysis import DeltaGamma
+from .analysis import Backtest
+from .analysis import SimulationCache
 
 from .portfolio import Stock
 from .portfolio import Call
 from .portfolio import Put
 from .portfolio import Portfolio
+from .portfolio import ExposureMatrix
+
+
+def __getattr__(name):
+    # the Bokeh app is only imported when it is actually used
+    if name == 'riskyapp':
+        import importlib
+        return importlib.import_module('.riskyapp', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-from . import riskyapp
@@ -1 +1,4 @@
-from .analysis import Analysis
\ No newline at end of file
+from .analysis import Analysis
+from .deltagamma import DeltaGamma
+from .backtest import Backtest
+from .cache import SimulationCache
@@ -1,21 +1,45 @@
-from bokeh.plotting import figure, show
-import bokeh.palettes 
 import scipy
 import numpy as np
 import pandas as pd
 import h5py
 
+from ..portfolio import ExposureMatrix
+from .kde import BinnedKDE, fd_bins
 
 
 class Analysis:
     """
     Analysis objects take a simulation file (.h5) and provide
-    all the necessary plotting and analysis methods
+    all the necessary plotting and analysis methods.
+
+    Given a SimulationCache, the historical data and cross sections are
+    shared read-only with every other Analysis of the same file using
+    that cache, and close() should be called when done.
+
+    Kernel density estimates use the fast BinnedKDE unless kde_method
+    is set to 'gaussian' (scipy's exact gaussian_kde)
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, cache=None):
         self.filepath = filepath
-        self._fetch_information()
-        self.colors = bokeh.palettes.Dark2_5
+        self.cache = cache
+        self._shared = None
+        if cache is None:
+            self._fetch_information()
+        else:
+            self._fetch_shared_information()
+        self._colors = None
+        self.kde_method = 'binned'
+
+
+    @property
+    def colors(self):
+        if self._colors is None:
+            import bokeh.palettes
+            self._colors = bokeh.palettes.Dark2_5
+        return self._colors
+    @colors.setter
+    def colors(self, colors):
+        self._colors = colors
 
 
     def _fetch_information(self):
@@ -28,6 +52,26 @@ class Analysis:
             sim_ds = file['simulation']
             self.num_steps = sim_ds.shape[0]
             self.num_iterations = sim_ds.shape[1]//self.num_securities
+            if 'iterations' in sim_ds.attrs: # ignore any partially written block
+                self.num_iterations = min(self.num_iterations, int(sim_ds.attrs['iterations']))
+
+
+    def _fetch_shared_information(self):
+        self._shared = self.cache.acquire(self.filepath)
+        self.securities = self._shared.securities
+        self.num_securities = self._shared.num_securities
+        self.historical = self._shared.historical
+        self.num_steps = self._shared.num_steps
+        self.num_iterations = self._shared.num_iterations
+
+
+    def close(self):
+        """
+        Releases this analysis' reference to the shared cache
+        """
+        if self._shared is not None:
+            self.cache.release(self._shared)
+            self._shared = None
 
 
     def read_sim(self, sim_num):
@@ -44,19 +88,48 @@ class Analysis:
         return sim_df
 
 
+    def get_section(self, time_step, file=None):
+        """
+        Returns all simulation results for a single future time step
+        as an array of shape (num_iterations, num_securities).
+        An open simulation file can be passed to avoid reopening it
+        """
+        if self._shared is not None:
+            return self.cache.derived(self._shared, ('section', int(time_step)), \
+                                lambda: self._read_section(time_step, file))
+        return self._read_section(time_step, file)
+
+
+    def _read_section(self, time_step, file=None):
+        if file is None:
+            with h5py.File(self.filepath, 'r') as file:
+                return self._read_section(time_step, file)
+        cross_section = file['simulation'][time_step, :self.num_iterations*self.num_securities]
+        return cross_section.reshape(-1, self.num_securities) # row ii is iteration ii
+
+
+    def get_grid(self, time_steps=None):
+        """
+        Returns the simulation results for several time steps (default:
+        all of them) as an array of shape (num_iterations, num_steps,
+        num_securities)
+        """
+        width = self.num_iterations*self.num_securities
+        with h5py.File(self.filepath, 'r') as file:
+            if time_steps is None:
+                sections = file['simulation'][:, :width]
+            else:
+                sections = file['simulation'][np.sort(time_steps), :width]
+        sections = sections.reshape(len(sections), -1, self.num_securities)
+        return sections.transpose(1, 0, 2)
+
+
     def get_section_df(self, time_step):
         """
         Returns all simulation results for a single future time step.
         A "cross section" of the simulation results
         """
-        with h5py.File(self.filepath, 'r') as file:
-            cross_section = file['simulation'][time_step,:]
-
-        section_df = pd.DataFrame()
-        N = self.num_securities
-        for jj in range(N):
-            sec = self.securities[jj]
-            section_df[sec] = cross_section[jj::N] # jump by N steps for each security
+        section_df = pd.DataFrame(self.get_section(time_step), columns=self.securities)
         return section_df
     
 
@@ -64,6 +137,7 @@ class Analysis:
         """
         Plots a given simulation along with the historical data
         """
+        from bokeh.plotting import figure, show
         sim_df = self.read_sim_df(sim_num)
         df = pd.concat([self.historical, sim_df], ignore_index=True)
         L = len(self.historical)
@@ -90,6 +164,7 @@ class Analysis:
         Plots all simulations in the provided simulation dataset 
         alongside the historical data
         """
+        from bokeh.plotting import figure, show
         L = len(self.historical)
         N = self.num_securities
         index = np.arange( L + self.num_steps )
@@ -120,6 +195,7 @@ class Analysis:
 
     def plot_distributions(self, time_step, kde=True):
 
+        from bokeh.plotting import figure, show
         df = self.get_section_df(time_step)
 
         fig = figure(title=f'Price Distribution After {time_step} Steps ({self.num_iterations} iterations)',\
@@ -132,9 +208,8 @@ class Analysis:
             fig.quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:], \
                     color=color, alpha=0.45, legend_label=sec)
             if kde:
-                f = scipy.stats.gaussian_kde(data)
-                xmin = min(min(data), min(data))
-                xmax = max(max(data), max(data))
+                f = self.kernel_density(data, num_bins)
+                xmin, xmax = data.min(), data.max()
                 X = np.linspace(xmin, xmax, 1000)
                 fig.line(X, f(X), width=2, color=color)
         
@@ -144,27 +219,69 @@ class Analysis:
         return fig
 
 
+    def kernel_density(self, data, num_bins=None):
+        """
+        Returns a kernel density estimate of the data using kde_method.
+        The binned estimate reuses the Friedman-Diaconis bins (num_bins,
+        computed with fd_bins if not given)
+        """
+        if self.kde_method == 'gaussian':
+            return scipy.stats.gaussian_kde(data)
+        if self.kde_method != 'binned':
+            raise Exception(f'Unknown KDE method {self.kde_method}')
+        if num_bins is None:
+            num_bins = self.fd_bins(data)
+        return BinnedKDE(data, num_bins)
+
+
     def fd_bins(self, data):
         """
-        Returns the number of bins for a histogram according to the Friedman-Diaconis rule
+        Returns the number of bins for a histogram according to the
+        Friedman-Diaconis rule (see kde.fd_bins for the zero-IQR case)
         """
-        iqr = data.quantile(0.75) - data.quantile(0.25)
-        n = len(data)
-        bin_width = 2*iqr/ n**(1/3)
-        num_bins = (data.max() - data.min())/bin_width
-        return int(num_bins)
+        return fd_bins(data)
 
     
+    def elapsed_steps(self, time_step):
+        """
+        Number of time steps from today to the given simulation
+        time step (the first simulated step is one step from today)
+        """
+        return np.asarray(time_step) + 1
+
+
+    def portfolio_payoffs(self, portfolio, time_step):
+        """
+        Returns the mark-to-market P&L of the portfolio in every
+        simulated scenario at the given time step
+        """
+        exposure = ExposureMatrix([portfolio])
+        payoffs = exposure.payoffs(self.get_section(time_step), self.securities, \
+                                    self.elapsed_steps(time_step))
+        return payoffs[:, 0]
+
+
+    def portfolio_value_grid(self, portfolio, time_steps=None):
+        """
+        Returns the mark-to-market P&L of the portfolio over the whole
+        (iteration, step) grid for the given time steps (default: all),
+        with every option in every scenario revalued in one array computation
+        """
+        if time_steps is None:
+            time_steps = np.arange(self.num_steps)
+        time_steps = np.sort(time_steps)
+        exposure = ExposureMatrix([portfolio])
+        grid = self.get_grid(time_steps)
+        elapsed = self.elapsed_steps(time_steps)[None, :]
+        return exposure.payoffs(grid, self.securities, elapsed)[..., 0]
+
+
     def payoff_pdf(self, portfolio, time_step):
         """
         Returns a kernel density estimate of the portfolio payoff PDF
         """
-        df = self.get_section_df(time_step)
-        dataset = df.to_numpy()
-        pf_prices = [self.arrange_prices_for_portfolio(prices, portfolio) \
-                        for prices in dataset]
-        payoffs = [portfolio.payoff(prices) for prices in pf_prices]
-        kde = scipy.stats.gaussian_kde(payoffs)
+        payoffs = self.portfolio_payoffs(portfolio, time_step)
+        kde = self.kernel_density(payoffs)
         return kde
 
 
@@ -181,6 +298,67 @@ class Analysis:
         return VaR
 
 
+    def batch_risk(self, portfolios, time_steps, alpha=0.05, names=None, window=None):
+        """
+        Returns the VaR and expected shortfall (ES) of many portfolios
+        ("books") evaluated against this one simulation. The books are
+        compiled into a single ExposureMatrix (an ExposureMatrix may also
+        be passed directly) and each horizon's cross section is read once.
+
+        The result is indexed by (time_step, book) and has a final 'firm'
+        row per horizon for the aggregate of all books. The contribution
+        columns are the Euler allocations of the firm VaR and ES to each
+        book: the book's mean payoff in scenarios near the firm VaR and in
+        the firm's worst alpha tail respectively. ES contributions add up
+        to the firm ES; window sets how many neighbouring scenarios on
+        either side of the VaR scenario are averaged
+        """
+        if isinstance(portfolios, ExposureMatrix):
+            exposure = portfolios
+        else:
+            exposure = ExposureMatrix(portfolios, names)
+        if np.isscalar(time_steps):
+            time_steps = [time_steps]
+
+        columns = exposure.columns_for(self.securities)
+        frames = []
+        with h5py.File(self.filepath, 'r') as file:
+            for time_step in time_steps:
+                section = self.get_section(time_step, file)
+                elapsed = self.elapsed_steps(time_step)
+                payoffs = exposure.unit_payoffs(section, columns, elapsed) @ exposure.weights
+                frames.append(self._book_risk(payoffs, exposure.names, alpha, window))
+        return pd.concat(frames, keys=list(time_steps), names=['time_step', 'book'])
+
+
+    def _book_risk(self, payoffs, names, alpha, window=None):
+        """
+        Risk metrics for a (num_scenarios, num_books) array of payoffs
+        """
+        firm = payoffs.sum(axis=1)
+        S = len(firm)
+        k = max(int(np.ceil(alpha*S)), 1) # number of scenarios in the tail
+        if window is None:
+            window = max(int(np.sqrt(S))//2, 1)
+
+        order = np.argsort(firm)
+        tail = order[:k]
+        kvar = int(round(alpha*(S-1)))
+        near_var = order[max(kvar-window, 0):kvar+window+1]
+
+        books = np.column_stack([payoffs, firm])
+        VaR = np.quantile(books, alpha, axis=0)
+        ES = np.partition(books, k-1, axis=0)[:k].mean(axis=0)
+        var_contrib = payoffs[near_var].mean(axis=0)
+        es_contrib = payoffs[tail].mean(axis=0)
+
+        risk = pd.DataFrame({'VaR':VaR, 'ES':ES, \
+                    'VaR contribution':np.append(var_contrib, var_contrib.sum()), \
+                    'ES contribution':np.append(es_contrib, es_contrib.sum())}, \
+                    index=pd.Index(list(names)+['firm'], name='book'))
+        return risk
+
+
     def payoff_histogram(self, portfolio, time_step, alpha=0.05, x0=-10):
         """
         plots the value-at-risk of the given for portfolio 
@@ -188,17 +366,15 @@ class Analysis:
         kernel density estimate of the payoff distribution 
         function 
         """
-        df = self.get_section_df(time_step)
-        dataset = df.to_numpy()
-        pf_prices = [self.arrange_prices_for_portfolio(prices, portfolio) \
-                        for prices in dataset]
-        payoffs = [portfolio.payoff(prices) for prices in pf_prices]
-        kde = scipy.stats.gaussian_kde(payoffs)
+        from bokeh.plotting import figure, show
+        payoffs = self.portfolio_payoffs(portfolio, time_step)
+        num_bins = self.fd_bins(pd.Series(payoffs))
+        kde = self.kernel_density(payoffs, num_bins)
 
         cdf_alpha = lambda x: kde.integrate_box(-np.inf, x) - alpha
         VaR = scipy.optimize.newton(cdf_alpha, x0)
 
-        hist, edges = np.histogram(payoffs, density=True, bins=self.fd_bins(pd.Series(payoffs)))
+        hist, edges = np.histogram(payoffs, density=True, bins=num_bins)
         
         neg = edges[edges < 0]
         lneg = neg[neg < VaR]
@@ -0,0 +1,191 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+import copy
+import os
+import scipy
+import numpy as np
+import pandas as pd
+
+from ..models import GBM
+from ..portfolio import ExposureMatrix
+
+
+
+def kupiec_test(exceptions, alpha):
+    """
+    Kupiec's proportion-of-failures likelihood ratio test that the
+    VaR exception rate equals alpha. Returns (LR statistic, p-value)
+    """
+    exceptions = np.asarray(exceptions, dtype=bool)
+    T = len(exceptions)
+    x = exceptions.sum()
+    xlogy = scipy.special.xlogy
+    log_null = xlogy(T-x, 1-alpha) + xlogy(x, alpha)
+    log_alt = xlogy(T-x, 1-x/T) + xlogy(x, x/T)
+    LR = -2*(log_null - log_alt)
+    return LR, scipy.stats.chi2.sf(LR, 1)
+
+
+def christoffersen_test(exceptions):
+    """
+    Christoffersen's likelihood ratio test that VaR exceptions are
+    independent (not clustered) over time. Returns (LR statistic, p-value)
+    """
+    exceptions = np.asarray(exceptions, dtype=int)
+    prev, curr = exceptions[:-1], exceptions[1:]
+    n00 = np.sum((prev == 0) & (curr == 0))
+    n01 = np.sum((prev == 0) & (curr == 1))
+    n10 = np.sum((prev == 1) & (curr == 0))
+    n11 = np.sum((prev == 1) & (curr == 1))
+    pi01 = n01/(n00+n01) if n00+n01 > 0 else 0
+    pi11 = n11/(n10+n11) if n10+n11 > 0 else 0
+    pi = (n01+n11)/(n00+n01+n10+n11)
+    xlogy = scipy.special.xlogy
+    log_null = xlogy(n00+n10, 1-pi) + xlogy(n01+n11, pi)
+    log_alt = xlogy(n00, 1-pi01) + xlogy(n01, pi01) + xlogy(n10, 1-pi11) + xlogy(n11, pi11)
+    LR = -2*(log_null - log_alt)
+    return LR, scipy.stats.chi2.sf(LR, 1)
+
+
+
+class Backtest:
+    """
+    Backtest objects run a rolling-window backtest of one-step VaR for a
+    portfolio. For every day the model is calibrated to the preceding
+    window of prices, the next step is simulated in memory and the VaR
+    and ES forecasts are compared with the realized P&L.
+
+    Dense GBM models are recalibrated incrementally: the window's
+    log-return sums are updated by one row in and one row out instead of
+    being recomputed. Other models are recalibrated from the window in
+    memory. Windows are split into contiguous chunks run in parallel
+    worker processes. Positions are held constant, so options keep the
+    same time to expiry every day
+    """
+    def __init__(self, model, portfolio, window, alpha=0.05, num_iter=10000, \
+                    calibrate_kwargs=None, refresh=250):
+        self.model = model
+        self.portfolio = portfolio
+        self.exposure = ExposureMatrix([portfolio])
+        self.window = window
+        self.alpha = alpha
+        self.num_iter = num_iter
+        self.calibrate_kwargs = {} if calibrate_kwargs is None else calibrate_kwargs
+        if refresh < 1:
+            raise Exception('refresh must be at least 1')
+        self.refresh = refresh # windows between full recomputations of rolling sums
+        self.results = None
+        self.summary = None
+
+
+    def run(self, historical, workers=None, seed=None):
+        """
+        Runs the backtest over a dataframe of historical prices (one
+        column per security). Returns a dataframe indexed by the date of
+        each forecast P&L; test statistics and timings are in self.summary
+        """
+        start_time = time()
+        prices = historical.dropna()
+        L = len(prices)
+        if L < self.window + 2:
+            raise Exception('Not enough history for a single backtest window')
+        ends = np.arange(self.window, L-1) # last price index in each window
+
+        workers = os.cpu_count() if workers is None else workers
+        chunks = [chunk for chunk in np.array_split(ends, max(workers, 1)) if len(chunk) != 0]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = [(self, prices, chunk, seq) for chunk, seq in zip(chunks, seeds)]
+        if len(chunks) == 1:
+            outputs = [_run_chunk(*args[0])]
+        else:
+            with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+                outputs = list(executor.map(_run_chunk, *zip(*args)))
+
+        results = pd.concat(outputs)
+        results.index = prices.index[results.index + 1]
+        results.index.name = 'date'
+        self.results = results
+        self.summary = self._summarize(results, time() - start_time)
+        return results
+
+
+    def _summarize(self, results, elapsed):
+        exceptions = results['exception'].values
+        LR_pof, p_pof = kupiec_test(exceptions, self.alpha)
+        LR_ind, p_ind = christoffersen_test(exceptions)
+        LR_cc = LR_pof + LR_ind
+        return {'windows':len(results), \
+                'exceptions':int(exceptions.sum()), \
+                'expected exceptions':self.alpha*len(results), \
+                'exception rate':exceptions.mean(), \
+                'kupiec LR':LR_pof, 'kupiec p-value':p_pof, \
+                'christoffersen LR':LR_ind, 'christoffersen p-value':p_ind, \
+                'conditional coverage LR':LR_cc, \
+                'conditional coverage p-value':scipy.stats.chi2.sf(LR_cc, 2), \
+                'total time':elapsed, \
+                'calibration time':results['calibration time'].sum(), \
+                'simulation time':results['simulation time'].sum(), \
+                'windows per second':len(results)/elapsed}
+
+
+    def _window_pnl(self, securities, today, prices):
+        """
+        P&L of the portfolio moving from today's prices to prices
+        (shape (..., num_securities)) over one step
+        """
+        now = self.exposure.payoffs(today[None, :], securities, 0)[0, 0]
+        return self.exposure.payoffs(prices, securities, 1)[..., 0] - now
+
+
+
+def _run_chunk(backtest, prices, ends, seed_sequence):
+    """
+    Runs the backtest windows ending at the given price indices. Runs in
+    a worker process, so takes everything it needs as arguments
+    """
+    np.random.seed(seed_sequence.generate_state(1)[0])
+    model = copy.deepcopy(backtest.model)
+    securities = list(prices.columns)
+    P = prices.to_numpy(dtype=float)
+    logrets = np.log(P[1:]/P[:-1]) # row i is the return from price i to i+1
+    W = backtest.window
+    incremental = isinstance(model, GBM) and backtest.calibrate_kwargs.get('num_factors') is None
+    alpha = backtest.alpha
+    k = max(int(np.ceil(alpha*backtest.num_iter)), 1)
+
+    if incremental:
+        # rolling sums of the window's log-returns and their outer products
+        N = P.shape[1]
+        S1, S2 = np.zeros(N), np.zeros((N, N))
+        model.add_historical(prices.iloc[ends[0]-W:ends[0]+1])
+
+    rows = []
+    for n, t in enumerate(ends):
+        t0 = time()
+        if incremental and n % backtest.refresh != 0:
+            # one return enters the window and one leaves
+            S1 += logrets[t-1] - logrets[t-W-1]
+            S2 += np.outer(logrets[t-1], logrets[t-1]) - np.outer(logrets[t-W-1], logrets[t-W-1])
+        elif incremental:
+            window_logrets = logrets[t-W:t]
+            S1 = window_logrets.sum(axis=0)
+            S2 = window_logrets.T @ window_logrets
+        if incremental:
+            mu = S1/W
+            cov = (S2 - W*np.outer(mu, mu))/(W-1)
+            model.calibrate_moments(mu, cov, P[t])
+        else:
+            model.add_historical(prices.iloc[t-W:t+1])
+            model.calibrate(**backtest.calibrate_kwargs)
+        t1 = time()
+
+        scenarios = model.simulate_block(1, backtest.num_iter)[:, 0, :]
+        pnl = backtest._window_pnl(securities, P[t], scenarios)
+        VaR = np.quantile(pnl, alpha)
+        ES = np.partition(pnl, k-1)[:k].mean()
+        realized = backtest._window_pnl(securities, P[t], P[t+1][None, :])[0]
+        t2 = time()
+
+        rows.append({'VaR':VaR, 'ES':ES, 'realized':realized, 'exception':realized < VaR, \
+                     'calibration time':t1-t0, 'simulation time':t2-t1})
+    return pd.DataFrame(rows, index=ends)
@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import threading
+import os
+import numpy as np
+import pandas as pd
+import h5py
+
+
+
+class SharedSimulation:
+    """
+    The read-only data of one simulation file held by a SimulationCache:
+    the summary information and historical data Analysis needs, plus any
+    derived arrays (e.g. cross sections) computed from it so far
+    """
+    def __init__(self, key, filepath):
+        self.key = key
+        self.filepath = filepath
+        self.refcount = 0
+        self.derived = {}
+        self.lock = threading.Lock() # serializes reads of this file's derived data
+        with h5py.File(filepath, 'r') as file:
+            hist_ds = file['historical']
+            historical = hist_ds[:]
+            historical.setflags(write=False)
+            self.securities = hist_ds.attrs['securities']
+            self.num_securities = len(self.securities)
+            self.historical = pd.DataFrame(historical, columns=self.securities, copy=False)
+            sim_ds = file['simulation']
+            self.num_steps = sim_ds.shape[0]
+            self.num_iterations = sim_ds.shape[1]//self.num_securities
+            if 'iterations' in sim_ds.attrs:
+                self.num_iterations = min(self.num_iterations, int(sim_ds.attrs['iterations']))
+        self.nbytes = historical.nbytes
+
+
+
+class SimulationCache:
+    """
+    A process-wide cache of opened simulation files shared by many
+    Analysis objects (e.g. one per Bokeh app session). Entries are keyed
+    by file path and modification time, so a rewritten file is reopened.
+    Entries are reference counted: Analysis objects acquire them when
+    created and release them when closed. Derived arrays are evicted in
+    least recently used order, and then unreferenced files, whenever the
+    cache grows beyond its memory budget (in bytes)
+    """
+    def __init__(self, budget=2*1024**3):
+        self.budget = budget
+        self._entries = {}
+        self._lru = OrderedDict() # (entry key, derived name) -> nbytes, oldest first
+        self._last_used = {} # entry key -> counter
+        self._counter = 0
+        self._lock = threading.RLock()
+
+
+    @property
+    def memory_usage(self):
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values()) + sum(self._lru.values())
+
+
+    def _key(self, filepath):
+        filepath = os.path.abspath(filepath)
+        return (filepath, os.stat(filepath).st_mtime_ns)
+
+
+    def _touch(self, key):
+        self._counter += 1
+        self._last_used[key] = self._counter
+
+
+    def acquire(self, filepath):
+        """
+        Returns the shared data of a simulation file, opening it on the
+        first request, and counts a new reference to it
+        """
+        key = self._key(filepath)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = SharedSimulation(key, key[0])
+                self._entries[key] = entry
+            entry.refcount += 1
+            self._touch(key)
+            self._evict()
+        return entry
+
+
+    def release(self, entry):
+        """
+        Drops a reference; the entry stays cached until evicted
+        """
+        with self._lock:
+            entry.refcount = max(entry.refcount - 1, 0)
+            self._evict()
+
+
+    def derived(self, entry, name, compute):
+        """
+        Returns the derived data called name for an entry, computing it
+        with compute() (once, even if requested concurrently) if needed
+        """
+        with entry.lock:
+            with self._lock:
+                if name in entry.derived:
+                    self._lru.move_to_end((entry.key, name))
+                    self._touch(entry.key)
+                    return entry.derived[name]
+            value = compute()
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+            with self._lock:
+                entry.derived[name] = value
+                self._lru[(entry.key, name)] = getattr(value, 'nbytes', 0)
+                self._touch(entry.key)
+                self._evict()
+        return value
+
+
+    def _evict(self):
+        """
+        Frees derived data, then unreferenced files, until within budget
+        """
+        usage = self.memory_usage
+        while usage > self.budget and len(self._lru) != 0:
+            (key, name), nbytes = self._lru.popitem(last=False)
+            entry = self._entries.get(key)
+            if entry is not None: # else dropped by clear() while still in use
+                entry.derived.pop(name, None)
+            usage -= nbytes
+        unreferenced = sorted((self._last_used[key], key) for key, entry in self._entries.items() \
+                                if entry.refcount == 0)
+        for _, key in unreferenced:
+            if usage <= self.budget:
+                break
+            usage -= self._entries.pop(key).nbytes
+            self._last_used.pop(key)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._lru.clear()
+            self._last_used.clear()
+
+
+
+shared_cache = SimulationCache(int(os.environ.get('RISKY_CACHE_BUDGET', 2*1024**3)))
@@ -0,0 +1,152 @@
+import scipy
+import numpy as np
+import pandas as pd
+
+from ..models import GBM
+from ..portfolio import ExposureMatrix
+
+
+
+class DeltaGamma:
+    """
+    DeltaGamma objects give parametric (simulation free) portfolio
+    risk for a calibrated GBM model. The portfolio P&L at a horizon is
+    expanded to second order in the log-returns of its underlyings,
+    which are exactly normal under GBM, and VaR/ES follow either from
+    the normal distribution of the linear term (delta-normal) or from
+    a Cornish-Fisher expansion of the full quadratic (delta-gamma)
+    """
+    def __init__(self, model, portfolio):
+        if not isinstance(model, GBM) or not model.iscalibrated:
+            raise Exception('Delta-gamma risk needs a calibrated GBM model')
+        self.model = model
+        self.portfolio = portfolio
+        self.exposure = ExposureMatrix([portfolio])
+        # restrict everything to the securities the portfolio depends on
+        self.securities = list(dict.fromkeys(self.exposure.securities))
+        index = {sec:jj for jj,sec in enumerate(model.securities)}
+        missing = [sec for sec in self.securities if sec not in index]
+        if len(missing) != 0:
+            raise Exception(f'Model is not calibrated for {missing}')
+        self._model_columns = np.array([index[sec] for sec in self.securities], dtype=int)
+        self._columns = self.exposure.columns_for(self.securities)
+
+
+    def elapsed_steps(self, time_step):
+        """
+        Number of time steps from today to the given simulation time
+        step, as in Analysis
+        """
+        return time_step + 1
+
+
+    def sensitivities(self, time_step):
+        """
+        Returns the P&L at unchanged prices and the delta vector and gamma
+        matrix of the portfolio with respect to the log-returns of its
+        underlyings, for a revaluation at the given time step
+        """
+        elapsed = self.elapsed_steps(time_step)
+        X0 = self.model.X0[self._model_columns]
+        prices = X0[None, :]
+        weights = self.exposure.weights[:, 0]
+
+        base = self.exposure.unit_payoffs(prices, self._columns, elapsed)[0] @ weights
+        unit_delta, unit_gamma = self.exposure.unit_greeks(prices, self._columns, elapsed)
+        # aggregate per-instrument greeks onto their underlyings
+        M = len(self.securities)
+        delta_S = np.bincount(self._columns, weights=unit_delta[0]*weights, minlength=M)
+        gamma_S = np.bincount(self._columns, weights=unit_gamma[0]*weights, minlength=M)
+
+        # chain rule for S = X0*exp(x)
+        delta = delta_S * X0
+        gamma = np.diag(gamma_S * X0**2 + delta_S * X0)
+        return base, delta, gamma
+
+
+    def cumulants(self, time_step, method='delta-gamma'):
+        """
+        Returns the first four cumulants of the approximated P&L
+        """
+        base, delta, gamma = self.sensitivities(time_step)
+        h = self.elapsed_steps(time_step)
+        m = h*self.model.mu[self._model_columns]
+        cov = h*self.model.covariance(self._model_columns)
+
+        if method == 'delta-normal':
+            return np.array([base + delta @ m, delta @ cov @ delta, 0, 0])
+        if method != 'delta-gamma':
+            raise Exception(f'Unknown method {method}')
+
+        b = delta + gamma @ m
+        GS = gamma @ cov
+        GS2 = GS @ GS
+        k1 = base + delta @ m + 0.5*m @ gamma @ m + 0.5*np.trace(GS)
+        k2 = b @ cov @ b + 0.5*np.trace(GS2)
+        k3 = 3*b @ cov @ GS @ b + np.trace(GS2 @ GS)
+        k4 = 12*b @ cov @ GS2 @ b + 3*np.trace(GS2 @ GS2)
+        return np.array([k1, k2, k3, k4])
+
+
+    def _quantile(self, cumulants, alpha):
+        """
+        Cornish-Fisher approximation to the alpha-quantile
+        """
+        k1, k2, k3, k4 = cumulants
+        z = scipy.stats.norm.ppf(alpha)
+        if k2 <= 0:
+            return k1 + 0*z
+        s = k3 / k2**1.5
+        k = k4 / k2**2
+        w = z + (z**2-1)*s/6 + (z**3-3*z)*k/24 - (2*z**3-5*z)*s**2/36
+        return k1 + np.sqrt(k2)*w
+
+
+    def value_at_risk(self, time_step, alpha=0.05, method='delta-gamma'):
+        """
+        Returns the parametric value-at-risk (the alpha-quantile of the
+        P&L, as in Analysis.value_at_risk). method is 'delta-normal' or
+        'delta-gamma'
+        """
+        return float(self._quantile(self.cumulants(time_step, method), alpha))
+
+
+    def expected_shortfall(self, time_step, alpha=0.05, method='delta-gamma', num_points=1000):
+        """
+        Returns the parametric expected shortfall (the mean P&L in the
+        worst alpha cases), integrating the Cornish-Fisher quantile
+        function over (0, alpha)
+        """
+        cumulants = self.cumulants(time_step, method)
+        if method == 'delta-normal':
+            z = scipy.stats.norm.ppf(alpha)
+            return float(cumulants[0] - np.sqrt(cumulants[1])*scipy.stats.norm.pdf(z)/alpha)
+        u = alpha*(np.arange(num_points) + 0.5)/num_points
+        return float(self._quantile(cumulants, u).mean())
+
+
+    def compare(self, analysis, time_steps, alpha=0.05):
+        """
+        Compares the delta-normal and delta-gamma estimates with the
+        Monte Carlo VaR/ES from a simulation of the same model. The
+        relative errors show where the approximations break down
+        (typically for option-heavy books and at long horizons)
+        """
+        if np.isscalar(time_steps):
+            time_steps = [time_steps]
+        mc = analysis.batch_risk([self.portfolio], time_steps, alpha, names=['portfolio'])
+
+        rows = []
+        for time_step in time_steps:
+            row = {'time_step':time_step, \
+                   'MC VaR':mc.loc[(time_step, 'portfolio'), 'VaR'], \
+                   'MC ES':mc.loc[(time_step, 'portfolio'), 'ES']}
+            for method in ('delta-normal', 'delta-gamma'):
+                VaR = self.value_at_risk(time_step, alpha, method)
+                ES = self.expected_shortfall(time_step, alpha, method)
+                row[f'{method} VaR'] = VaR
+                row[f'{method} ES'] = ES
+                row[f'{method} VaR error'] = (VaR - row['MC VaR']) / abs(row['MC VaR'])
+                row[f'{method} ES error'] = (ES - row['MC ES']) / abs(row['MC ES'])
+            rows.append(row)
+        return pd.DataFrame(rows).set_index('time_step')
@@ -0,0 +1,3 @@
+from .runner import main
+from .runner import run_jobs
+from .runner import Job
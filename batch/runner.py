@@ -0,0 +1,317 @@
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+import argparse
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+from ..models import GBM, GaussianCopula, TCopula, HistoricalSimulation
+from ..analysis import Analysis
+from ..portfolio import Stock, Call, Put, Portfolio, ExposureMatrix
+
+
+MODELS = {'gbm':GBM, 'gaussian-copula':GaussianCopula, 't-copula':TCopula, \
+          'historical':HistoricalSimulation}
+
+POSITIONS = {'stock':Stock, 'call':Call, 'put':Put}
+
+
+
+def load_prices(path, securities=None, index_col='auto'):
+    """
+    Loads historical prices from a CSV or Parquet file, one column per
+    security. With index_col='auto' the first CSV column is taken as the
+    index only if it is not numeric (e.g. dates) or has no name (as
+    written by pandas); otherwise index_col is passed to pd.read_csv
+    (None for no index column)
+    """
+    if path.endswith('.parquet') or path.endswith('.pq'):
+        prices = pd.read_parquet(path)
+    elif index_col == 'auto':
+        prices = pd.read_csv(path)
+        first = prices.columns[0]
+        if str(first).startswith('Unnamed:') or not pd.api.types.is_numeric_dtype(prices[first]):
+            prices = prices.set_index(first)
+    else:
+        prices = pd.read_csv(path, index_col=index_col)
+    if securities is not None:
+        prices = prices[securities]
+    return prices
+
+
+def build_portfolio(positions):
+    """
+    Builds a Portfolio from a list of position specs such as
+    {"type": "stock", "security": "AAPL", "shares": 50, "init_price": 169.8} or
+    {"type": "call", "security": "MSFT", "strike": 310, "premium": 1.5,
+     "shares": 100, "expiry": 20, "rate": 0.0001, "volatility": 0.015}
+    """
+    built = []
+    for spec in positions:
+        spec = dict(spec)
+        kind = spec.pop('type').lower()
+        if kind not in POSITIONS:
+            raise Exception(f'Unknown position type {kind}')
+        security = spec.pop('security')
+        if kind == 'stock':
+            if spec.get('init_price') is None:
+                raise Exception(f'Stock position in {security} needs an init_price')
+            built.append(Stock(security, spec.pop('shares'), spec.pop('init_price')))
+        else:
+            underlying = Stock(security, spec.pop('shares', 100))
+            built.append(POSITIONS[kind](underlying, spec.pop('strike'), spec.pop('premium'), **spec))
+    return Portfolio(built)
+
+
+
+def job_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def default_output(path, output_dir=None):
+    """
+    Where a job's result goes unless its spec names an output: next to
+    the spec, or in output_dir
+    """
+    directory = os.path.dirname(os.path.abspath(path)) if output_dir is None else output_dir
+    return os.path.join(directory, f'{job_name(path)}.result.json')
+
+
+
+class Job:
+    """
+    A batch job read from a JSON spec. Paths in the spec are relative to
+    the spec file. Example:
+
+    {"prices": "prices.csv", "model": "t-copula", "model_options": {"dof": 4},
+     "calibration": {"num_factors": 5}, "num_steps": 10, "num_iter": 10000,
+     "seed": 1, "alpha": 0.05, "time_steps": [0, 9],
+     "portfolios": {"book-a": [...positions...], "book-b": "book-b.json"},
+     "output": "result.json"}
+    """
+    def __init__(self, path, output_dir=None):
+        self.path = os.path.abspath(path)
+        self.name = job_name(path)
+        self.output = default_output(path, output_dir)
+        with open(self.path) as file:
+            spec = json.load(file)
+        self.spec = spec
+
+        self.prices = self._resolve(spec['prices'])
+        self.securities = spec.get('securities')
+        self.index_col = spec.get('index_col', 'auto')
+        self.model = spec.get('model', 'gbm')
+        if self.model not in MODELS:
+            raise Exception(f'Unknown model {self.model}')
+        self.model_options = spec.get('model_options', {})
+        self.calibration = spec.get('calibration', {})
+        self.num_steps = spec.get('num_steps', 1)
+        self.num_iter = spec.get('num_iter', 10000)
+        self.block_size = spec.get('block_size', 1000)
+        self.seed = spec.get('seed')
+        self.alpha = spec.get('alpha', 0.05)
+        self.time_steps = spec.get('time_steps', [self.num_steps-1])
+        self.portfolios = {}
+        for name, positions in spec['portfolios'].items():
+            if isinstance(positions, str):
+                with open(self._resolve(positions)) as file:
+                    positions = json.load(file)
+            self.portfolios[name] = positions
+
+        if 'output' in spec:
+            self.output = self._resolve(spec['output'])
+
+
+    def _resolve(self, path):
+        return os.path.join(os.path.dirname(self.path), path)
+
+
+    def universe_key(self):
+        """
+        Jobs with equal keys share data loading, calibration and simulation
+        """
+        mtime = os.path.getmtime(self.prices) if os.path.isfile(self.prices) else None
+        return json.dumps([self.prices, mtime, self.securities, self.index_col, \
+                    self.model, self.model_options, self.calibration, self.num_steps, \
+                    self.num_iter, self.block_size, self.seed], sort_keys=True)
+
+
+
+def run_group(jobs, simulation_dir=None):
+    """
+    Loads, calibrates and simulates once for a group of jobs sharing a
+    universe, then evaluates every portfolio of every job in a single
+    batch against the simulation and writes each job's results. The
+    simulation file is kept in simulation_dir if one is given
+    """
+    if simulation_dir is None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            return _run_group(jobs, tmpdir, keep=False)
+    # a directory per group, so concurrent groups never pick the same file name
+    return _run_group(jobs, tempfile.mkdtemp(prefix='risky-', dir=simulation_dir), keep=True)
+
+
+def _run_group(jobs, simulation_dir, keep):
+    start_time = time()
+    first = jobs[0]
+    prices = load_prices(first.prices, first.securities, first.index_col)
+    model = MODELS[first.model](**first.model_options)
+    model.add_historical(prices)
+    model.calibrate(**first.calibration)
+    calibrated_time = time()
+    filepath = model.run_simulation(first.num_steps, first.num_iter, path=simulation_dir, \
+                        block_size=first.block_size, seed=first.seed)
+    simulated_time = time()
+
+    analysis = Analysis(filepath)
+    # a job with a bad portfolio fails on its own, not with its whole group
+    names, portfolios, failed = [], [], {}
+    for job in jobs:
+        try:
+            built = {name:build_portfolio(positions) for name, positions in job.portfolios.items()}
+            ExposureMatrix(list(built.values())).columns_for(analysis.securities)
+            bad_steps = [t for t in job.time_steps if not 0 <= t < analysis.num_steps]
+            if len(bad_steps) != 0:
+                raise Exception(f'Time steps {bad_steps} are outside the simulation')
+        except Exception as error:
+            failed[job.path] = repr(error)
+            continue
+        for name, portfolio in built.items():
+            names.append((job.name, name))
+            portfolios.append(portfolio)
+    ok = [job for job in jobs if job.path not in failed]
+    time_steps = sorted(set(t for job in ok for t in job.time_steps))
+    alphas = sorted(set(job.alpha for job in ok))
+    risk = {alpha:analysis.batch_risk(portfolios, time_steps, alpha, \
+                    names=[f'{job}/{name}' for job,name in names]) for alpha in alphas}
+    end_time = time()
+
+    outcomes = []
+    for job in jobs:
+        if job.path in failed:
+            _write_json(job.output, {'job':job.name, 'error':failed[job.path]})
+            outcomes.append((job.output, failed[job.path]))
+            continue
+        result = {'job':job.name, 'model':job.model, 'num_iter':analysis.num_iterations, \
+                  'num_steps':job.num_steps, 'alpha':job.alpha, 'simulation':filepath if keep else None, \
+                  'portfolios':{}, \
+                  'timing':{'calibration':calibrated_time-start_time, \
+                            'simulation':simulated_time-calibrated_time, \
+                            'risk':end_time-simulated_time, \
+                            'shared_with':len(jobs)-1}}
+        table = risk[job.alpha]
+        for name in job.portfolios:
+            book = f'{job.name}/{name}'
+            result['portfolios'][name] = { str(t):{'VaR':table.loc[(t, book), 'VaR'], \
+                                                   'ES':table.loc[(t, book), 'ES']} \
+                                           for t in job.time_steps }
+        _write_json(job.output, result)
+        outcomes.append((job.output, None))
+    analysis.close()
+    return outcomes
+
+
+def _write_json(path, result):
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2, default=lambda x: x.item() if isinstance(x, np.generic) else str(x))
+
+
+def _run_group_safely(jobs, simulation_dir):
+    """
+    Runs a group, returning an (output, error) pair per job; if the
+    shared work fails every job of the group records the error
+    """
+    try:
+        return run_group(jobs, simulation_dir)
+    except Exception as error:
+        for job in jobs:
+            _write_json(job.output, {'job':job.name, 'error':repr(error)})
+        return [(job.output, repr(error)) for job in jobs]
+
+
+def _load_job(path, output_dir):
+    """
+    Reads a job spec, returning (job, None), or (None, outcome) after
+    writing the error as the job's result if the spec cannot be loaded
+    """
+    try:
+        return Job(path, output_dir), None
+    except Exception as error:
+        output = default_output(path, output_dir)
+        _write_json(output, {'job':job_name(path), 'error':repr(error)})
+        return None, (output, repr(error))
+
+
+def run_jobs(job_paths, max_workers=1, simulation_dir=None, output_dir=None):
+    """
+    Runs the given job spec files, grouping jobs that share a universe
+    and running up to max_workers groups concurrently. Returns the list
+    of errors (empty if every job succeeded)
+    """
+    jobs, outcomes = [], []
+    for path in job_paths:
+        job, outcome = _load_job(path, output_dir)
+        if job is None:
+            outcomes.append(outcome)
+        else:
+            jobs.append(job)
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.universe_key(), []).append(job)
+    groups = list(groups.values())
+
+    if max_workers <= 1 or len(groups) <= 1:
+        results = [_run_group_safely(group, simulation_dir) for group in groups]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_run_group_safely, groups, [simulation_dir]*len(groups)))
+    for group_outcomes in results:
+        outcomes += group_outcomes
+
+    errors = []
+    for output, error in outcomes:
+        print(f'{"FAILED" if error else "Wrote"} {output}' + (f': {error}' if error else ''))
+        if error:
+            errors.append(error)
+    return errors
+
+
+def _is_job_spec(path):
+    """
+    Whether a file in a job directory is a job spec (and not e.g. a
+    portfolio referenced by one, or a result)
+    """
+    if not path.endswith('.json') or path.endswith('.result.json'):
+        return False
+    try:
+        with open(path) as file:
+            spec = json.load(file)
+    except ValueError:
+        return True # unreadable: run it, so the failure gets reported
+    return isinstance(spec, dict) and 'prices' in spec and 'portfolios' in spec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m risky', \
+                description='Calibrate, simulate and write VaR/ES for batch job specs')
+    parser.add_argument('jobs', nargs='+', help='job spec JSON files or directories of them')
+    parser.add_argument('--max-workers', type=int, default=1, \
+                help='number of job groups to run concurrently')
+    parser.add_argument('--simulation-dir', default=None, \
+                help='where to keep simulation files (default: temporary, deleted afterwards)')
+    parser.add_argument('--output-dir', default=None, \
+                help='where to write results (default: next to each job spec)')
+    args = parser.parse_args(argv)
+
+    job_paths = []
+    for path in args.jobs:
+        if os.path.isdir(path):
+            job_paths += [os.path.join(path, f) for f in sorted(os.listdir(path)) \
+                            if _is_job_spec(os.path.join(path, f))]
+        else:
+            job_paths.append(path)
+
+    errors = run_jobs(job_paths, args.max_workers, args.simulation_dir, args.output_dir)
+    return 1 if errors else 0
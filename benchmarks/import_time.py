@@ -0,0 +1,64 @@
+"""
+Import-time benchmark for headless use of risky.
+
+Imports the package in a fresh interpreter several times and fails
+(exit code 1) if the best import time exceeds the budget or if any of
+the plotting/app dependencies are loaded by a plain `import risky`.
+
+    python benchmarks/import_time.py [--budget SECONDS] [--repeat N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ['bokeh', 'IPython', 'statsmodels']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {package}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+'''
+
+
+def measure(package_dir, repeat):
+    parent, package = os.path.split(os.path.abspath(package_dir))
+    probe = PROBE.format(package=package, heavy=HEAVY_MODULES)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([parent, os.environ.get('PYTHONPATH', '')]))
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', probe], env=env, cwd=parent, \
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--budget', type=float, default=1.5, help='maximum import time in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters to time')
+    args = parser.parse_args()
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = measure(package_dir, args.repeat)
+    best = min(run['seconds'] for run in runs)
+    heavy = sorted(set(m for run in runs for m in run['heavy']))
+
+    print(f'import time: best {best:.3f} s over {args.repeat} runs (budget {args.budget:.3f} s)')
+    failed = False
+    if heavy:
+        print(f'FAIL: import loaded {heavy}')
+        failed = True
+    if best > args.budget:
+        print('FAIL: import time over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
 from .gbm import GBM
 from .gaussiancopula import GaussianCopula
 from .tcopula import TCopula
+from .historical import HistoricalSimulation
@@ -3,11 +3,14 @@ from abc import ABC, abstractmethod
 import pandas as pd
 import numpy as np
 import scipy
-from statsmodels.distributions.empirical_distribution import ECDF
+from .ecdf import ECDF
 import os
 from time import time
+import hashlib
 import h5py
 
+from ..portfolio import ExposureMatrix
+
 
 
 class AbstractModel(ABC):
@@ -56,9 +59,198 @@ class AbstractModel(ABC):
 
 
 
-    
-    def run_simulation(self, num_steps, num_iter, path=None):
+    def _sample_logreturns(self, num_samples):
+        """
+        Samples num_samples independent one-step log-returns of all
+        securities, shape (num_samples, num_securities). Models that
+        override this get vectorized block simulation
+        """
+        raise Exception(f'{self.name} model does not sample one-step log-returns')
+
+
+    @property
+    def _samples_logreturns(self):
+        return type(self)._sample_logreturns is not AbstractModel._sample_logreturns
+
+
+    def simulate_block(self, num_steps, num_iter):
+        """
+        Simulates num_iter independent paths num_steps into the future
+        at once. Returns an array of shape (num_iter, num_steps, num_securities)
+        """
+        if not self._iscalibrated:
+            raise Exception('Model must first be calibrated')
+        if not self._samples_logreturns:
+            return np.array([self.simulate_path(num_steps) for ii in range(num_iter)])
+        N = self._num_securities
+        logrets = self._sample_logreturns(num_iter*num_steps).reshape(num_iter, num_steps, N)
+        return self.X0 * np.exp(np.nancumsum(logrets, axis=1))
+
+
+    def run_simulation(self, num_steps, num_iter, path=None, filepath=None, block_size=1000, seed=None):
+        """
+        Simulates num_iter paths num_steps into the future and saves them
+        with the historical data in a HDF5 file, returning its path.
+
+        Paths are simulated and written in blocks of block_size iterations,
+        each drawn from its own seed derived from the file's seed, and the
+        file records how many blocks are complete after every block. Given
+        the filepath of an existing simulation, num_iter more iterations
+        are appended to it (after first finishing any interrupted run)
+        provided it was produced by the same calibration
+        """
         start_time = time()
+        if filepath is None:
+            filepath = self._new_simulation_filepath(path)
+        if not os.path.isfile(filepath):
+            self._create_simulation_file(filepath, num_steps, block_size, seed)
+
+        with h5py.File(filepath, 'a') as file:
+            dss = self._open_simulation(file, num_steps)
+            dss.attrs['target_iterations'] += num_iter
+            for _ in self._simulate_blocks(file):
+                pass
+
+        end_time = time()
+        print(f'Simulation finished in {round(end_time-start_time,2)} sec.\nSaved in {filepath}\n')
+        return filepath
+
+
+    def run_adaptive_simulation(self, portfolio, num_steps, alpha=0.05, rel_precision=0.01, \
+                    time_step=None, confidence=0.95, max_iter=1000000, time_budget=None, \
+                    path=None, filepath=None, block_size=1000, seed=None):
+        """
+        Simulates in blocks until the portfolio's VaR and expected
+        shortfall at time_step (default: the last step) are known to the
+        target relative precision, i.e. the half-width of their confidence
+        intervals is at most rel_precision times their size, or until
+        max_iter iterations or time_budget seconds are reached.
+
+        The file is the same as from run_simulation (and can be extended
+        the same way); the final estimates, their confidence intervals,
+        the achieved precision and the reason for stopping are recorded
+        in the attributes of its simulation dataset
+        """
+        start_time = time()
+        if filepath is None:
+            filepath = self._new_simulation_filepath(path)
+        if not os.path.isfile(filepath):
+            self._create_simulation_file(filepath, num_steps, block_size, seed)
+        if time_step is None:
+            time_step = num_steps - 1
+
+        N = self.num_securities
+        exposure = ExposureMatrix([portfolio])
+        columns = exposure.columns_for(self._securities)
+        payoff = lambda prices: exposure.unit_payoffs(prices, columns, time_step+1) @ exposure.weights[:, 0]
+
+        with h5py.File(filepath, 'a') as file:
+            dss = self._open_simulation(file, num_steps)
+            done = int(dss.attrs['iterations'])
+            # only the lowest payoffs are kept, enough for every run length up to the target
+            tail_size = self._tail_size(max(done, max_iter), alpha, confidence)
+            n = done
+            tail = self._merge_tail(np.empty(0), payoff(dss[time_step, :N*done].reshape(-1, N)), tail_size)
+            estimate = self._tail_estimate(tail, n, alpha, confidence)
+
+            stop_reason = 'max_iter'
+            if estimate['precision'] <= rel_precision:
+                stop_reason = 'precision'
+            else:
+                dss.attrs['target_iterations'] = max(done, max_iter)
+                for block in self._simulate_blocks(file):
+                    n += len(block)
+                    tail = self._merge_tail(tail, payoff(block[:, time_step, :]), tail_size)
+                    estimate = self._tail_estimate(tail, n, alpha, confidence)
+                    if estimate['precision'] <= rel_precision:
+                        stop_reason = 'precision'
+                        break
+                    if time_budget is not None and time() - start_time >= time_budget:
+                        stop_reason = 'time_budget'
+                        break
+                dss.attrs['target_iterations'] = dss.attrs['iterations']
+
+            dss.attrs['alpha'] = alpha
+            dss.attrs['risk_time_step'] = time_step
+            dss.attrs['confidence'] = confidence
+            dss.attrs['target_precision'] = rel_precision
+            dss.attrs['achieved_precision'] = estimate['precision']
+            dss.attrs['stop_reason'] = stop_reason
+            for key in ('VaR', 'VaR_ci', 'ES', 'ES_ci'):
+                dss.attrs[key] = estimate[key]
+            num_iter = int(dss.attrs['iterations'])
+
+        end_time = time()
+        print(f'Simulation finished in {round(end_time-start_time,2)} sec. ({stop_reason}: ' + \
+              f'{num_iter} iterations, precision {round(estimate["precision"],4)})\nSaved in {filepath}\n')
+        return filepath
+
+
+    def _tail_size(self, n, alpha, confidence):
+        """
+        Number of lowest payoffs _tail_estimate needs for n scenarios; it
+        does not decrease with n, so a tail kept for n serves any fewer
+        """
+        hi = int(scipy.stats.binom.ppf(1 - (1-confidence)/2, n, alpha))
+        return max(hi + 1, int(np.ceil(alpha*n)), int(np.floor(alpha*(n-1))) + 2)
+
+
+    def _merge_tail(self, tail, payoffs, tail_size):
+        """
+        The tail_size lowest values of tail and payoffs together (unsorted)
+        """
+        if len(tail) >= tail_size:
+            payoffs = payoffs[payoffs < tail.max()]
+        merged = np.concatenate([tail, payoffs])
+        if len(merged) > tail_size:
+            merged = np.partition(merged, tail_size-1)[:tail_size]
+        return merged
+
+
+    def _tail_estimate(self, tail, n, alpha, confidence):
+        """
+        VaR and ES, with confidence intervals, of n payoffs whose lowest
+        values (at least _tail_size of them) are tail: a distribution-free
+        order statistic interval for VaR and the asymptotic normal
+        interval for ES. The tail has ceil(alpha*n) scenarios, as in
+        Analysis.batch_risk. precision is the larger of the two relative
+        half-widths (inf while there is no tail yet)
+        """
+        k = int(np.ceil(alpha*n))
+        if k < 2 or n < 2:
+            return {'VaR':np.nan, 'VaR_ci':[np.nan, np.nan], 'ES':np.nan, \
+                    'ES_ci':[np.nan, np.nan], 'precision':np.inf}
+        beta = (1-confidence)/2
+        z = scipy.special.ndtri(1 - beta)
+        lo, hi = scipy.stats.binom.ppf([beta, 1 - beta], n, alpha).astype(int)
+        h = alpha*(n-1) # np.quantile's (linear) position of the VaR
+        q = int(np.floor(h))
+        ranks = sorted(set([k-1, q, min(q+1, n-1), max(lo-1, 0), min(hi, n-1)]))
+        x = np.partition(tail, ranks)
+
+        VaR = x[q] + (h-q)*(x[min(q+1, n-1)] - x[q])
+        ES = x[:k].mean()
+        VaR_ci = [x[max(lo-1, 0)], x[min(hi, n-1)]]
+        ES_se = np.sqrt((x[:k].var(ddof=1) + (1-alpha)*(ES-VaR)**2) / (n*alpha))
+        ES_ci = [ES - z*ES_se, ES + z*ES_se]
+
+        precision = max((VaR_ci[1]-VaR_ci[0]) / 2 / abs(VaR), z*ES_se / abs(ES))
+        return {'VaR':VaR, 'VaR_ci':VaR_ci, 'ES':ES, 'ES_ci':ES_ci, 'precision':precision}
+
+
+    def resume_simulation(self, filepath):
+        """
+        Finishes an interrupted simulation from its last complete block
+        """
+        with h5py.File(filepath, 'r') as file:
+            num_steps = file['simulation'].shape[0]
+        return self.run_simulation(num_steps, 0, filepath=filepath)
+
+
+    def _new_simulation_filepath(self, path=None):
+        """
+        Returns the first unused simulation file name in path
+        """
         if path == None:
             path = os.getcwd()
         filepath = lambda n: os.path.join(path, \
@@ -67,29 +259,106 @@ class AbstractModel(ABC):
         n = 0
         while os.path.isfile(filepath(n)):
             n += 1
-        filepath = filepath(n)
+        return filepath(n)
 
-        N = self.num_securities
-        simulation_size = (num_steps, N*num_iter)
 
-        simdataset = np.empty(simulation_size, dtype=float) #preallocate large array
-        for ii in range(num_iter):
-            simdataset[:, N*ii:N*(ii+1)] = self.simulate_path(num_steps)
-            
+    def _create_simulation_file(self, filepath, num_steps, block_size, seed):
+        """
+        Creates an empty, extendable simulation file
+        """
+        N = self.num_securities
+        if seed is None:
+            # drawn from the global generator, so np.random.seed still makes runs repeatable
+            seed = int(np.random.randint(0, 2**63, dtype=np.int64))
         with h5py.File(filepath, 'w') as file:
             L = len(self._historical_data)
             dsh = file.create_dataset('historical', shape=(L, N), \
                         dtype=float, data=self._historical_data[self._securities])
-            
-            dss = file.create_dataset('simulation', shape=simulation_size, \
-                        dtype=float, data=simdataset)
-            
+
+            # one chunk per time step (up to 1 MB) so cross sections read contiguously
+            chunk_width = min(N*block_size, 2**17)
+            dss = file.create_dataset('simulation', shape=(num_steps, 0), \
+                        maxshape=(num_steps, None), chunks=(1, chunk_width), dtype=float)
+
             dsh.attrs['securities'] = self._securities
             dss.attrs['securities'] = self._securities
+            dss.attrs['model'] = self.name
+            dss.attrs['calibration'] = self._calibration_fingerprint()
+            dss.attrs['seed'] = str(seed)
+            dss.attrs['block_size'] = block_size
+            dss.attrs['completed_blocks'] = 0
+            dss.attrs['iterations'] = 0
+            dss.attrs['target_iterations'] = 0
 
-        end_time = time()
-        print(f'Simulation finished in {round(end_time-start_time,2)} sec.\nSaved in {filepath}\n')
-        return filepath
+
+    def _open_simulation(self, file, num_steps):
+        """
+        Returns the simulation dataset of an open file after checking it
+        can be extended by this model
+        """
+        dss = file['simulation']
+        if 'calibration' not in dss.attrs:
+            raise Exception('Simulation file was not written in blocks and cannot be extended')
+        if dss.attrs['calibration'] != self._calibration_fingerprint():
+            raise Exception('Simulation file was produced by a different model calibration')
+        if dss.shape[0] != num_steps:
+            raise Exception(f'Simulation file has {dss.shape[0]} steps, not {num_steps}')
+        return dss
+
+
+    def _simulate_blocks(self, file):
+        """
+        Simulates and appends blocks until the file holds its target
+        number of iterations, yielding each block (num_iter, num_steps,
+        num_securities) once it is safely on disk
+        """
+        dss = file['simulation']
+        N = self.num_securities
+        num_steps = dss.shape[0]
+        block_size = int(dss.attrs['block_size'])
+        root_seed = np.random.SeedSequence(int(dss.attrs['seed']))
+        while dss.attrs['iterations'] < dss.attrs['target_iterations']:
+            done = int(dss.attrs['iterations'])
+            b = int(dss.attrs['completed_blocks'])
+            num_iter = min(block_size, int(dss.attrs['target_iterations']) - done)
+
+            # block b always uses the b-th seed of the stream
+            block_seed = np.random.SeedSequence(root_seed.entropy, spawn_key=(b,))
+            state = np.random.get_state()
+            try:
+                np.random.seed(block_seed.generate_state(4))
+                block = self.simulate_block(num_steps, num_iter)
+            finally:
+                np.random.set_state(state) # leaves the caller's random state alone
+
+            # drops any partially written block from an interrupted run
+            dss.resize((num_steps, N*(done+num_iter)))
+            dss[:, N*done:] = block.transpose(1, 0, 2).reshape(num_steps, N*num_iter)
+            file.flush()
+            dss.attrs['iterations'] = done + num_iter
+            dss.attrs['completed_blocks'] = b + 1
+            file.flush()
+            yield block
+
+
+    def _calibration_fingerprint(self):
+        """
+        Hash of the calibrated state of the model, used to check that a
+        simulation file is only extended by the same calibration
+        """
+        sha = hashlib.sha256()
+        sha.update(self.name.encode())
+        sha.update(str(list(self._securities)).encode())
+        sha.update(np.ascontiguousarray(self._historical_data[self._securities], dtype=float).tobytes())
+        for attr, value in sorted(vars(self).items()):
+            if isinstance(value, str):
+                value = value.encode()
+            elif value is None or isinstance(value, (int, float, np.ndarray)):
+                value = np.ascontiguousarray(value, dtype=float).tobytes()
+            else:
+                continue # e.g. dataframes and fitted marginals
+            sha.update(attr.encode() + value)
+        return sha.hexdigest()
 
     
 
@@ -104,7 +373,7 @@ class AbstractModel(ABC):
         self._historical_data = dataset
         self._securities = dataset.columns.to_list()
         self._num_securities = len(self._securities)
-        self._add_calculated_columns(self._historical_data)
+        self._historical_data = self._add_calculated_columns(self._historical_data)
         self._logret_columns = [f'{sec}-logret' for sec in self._securities]
 
         if self._iscalibrated:
@@ -113,13 +382,38 @@ class AbstractModel(ABC):
 
     def _add_calculated_columns(self, df):
         """
-        adds additional columns such as diff and log returns
+        returns df with additional columns such as diff and log returns
         """
-        for sec in self._securities:
-            data = df[sec]
-            df[f'{sec}-diff'] = data.diff()
-            df[f'{sec}-logret'] = [np.nan]+[np.log(data[i]/data[i-1]) \
-                                        for i in range(1,len(data))]
+        prices = df[self._securities]
+        diffs = prices.diff()
+        diffs.columns = [f'{sec}-diff' for sec in self._securities]
+        logrets = np.log(prices / prices.shift(1))
+        logrets.columns = [f'{sec}-logret' for sec in self._securities]
+        return pd.concat([df, diffs, logrets], axis=1)
+
+
+    def _factor_decomposition(self, data, num_factors, standardize=False):
+        """
+        Approximates the covariance (or correlation if standardize) of
+        the columns of data by num_factors principal components plus
+        diagonal idiosyncratic variance, without forming the dense N x N
+        matrix. Returns the (N, num_factors) loadings and the N
+        idiosyncratic variances
+        """
+        X = np.asarray(data, dtype=float)
+        X = X[~np.isnan(X).any(axis=1)]
+        T, N = X.shape
+        if num_factors < 1 or num_factors >= min(T, N):
+            raise Exception(f'Number of factors must be between 1 and {min(T, N)-1}')
+        X = X - X.mean(axis=0)
+        if standardize:
+            X = X / X.std(axis=0, ddof=1)
+        # economy SVD costs O(T^2 N) for short histories of many securities
+        _, S, Vt = np.linalg.svd(X, full_matrices=False)
+        loadings = Vt[:num_factors].T * S[:num_factors] / np.sqrt(T-1)
+        total_var = (X**2).sum(axis=0) / (T-1)
+        idio_var = np.maximum(total_var - (loadings**2).sum(axis=1), 1e-6*total_var)
+        return loadings, idio_var
 
 
     def _get_empirical_marginals(self):
@@ -136,6 +430,15 @@ class AbstractModel(ABC):
         self.ecdf_inv = ecdf_inv
 
 
+    def _marginal_logreturns(self, u):
+        """
+        Maps copula samples u of shape (num_securities, num_samples) to
+        log-returns through the inverse empirical marginals
+        """
+        return np.array([self.ecdf_inv[self._securities[i]]( u[i] ) \
+                            for i in range(self._num_securities)])
+
+
     def _monotone_fn_inverter(self, fn, x, vectorized=True, bounds_error=False, **keywords):
         """
         Given a monotone function fn (no checking is done to verify monotonicity)
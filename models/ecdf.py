@@ -0,0 +1,16 @@
+import numpy as np
+
+
+class ECDF:
+    """
+    Empirical cumulative distribution function of a sample. Matches
+    statsmodels' ECDF (right-continuous steps of 1/n), including its
+    handling of NaNs, which count towards n but are never <= any value
+    """
+    def __init__(self, x):
+        self.x = np.sort(np.asarray(x, dtype=float))
+        self.n = len(self.x)
+        self.y = np.r_[0, np.linspace(1./self.n, 1, self.n)]
+
+    def __call__(self, values):
+        return self.y[np.searchsorted(self.x, values, side='right')]
@@ -5,6 +5,8 @@ import scipy
 
 
 class GaussianCopula(AbstractModel):
+    num_factors = None
+
     def __init__(self):
         pass
         
@@ -14,10 +16,12 @@ class GaussianCopula(AbstractModel):
         return 'gaussian-copula'
 
 
-    def calibrate(self):
+    def calibrate(self, num_factors=None):
         """
         Calibrate the Gaussian copula (i.e. fit model parameters to the
-        provided historical data)
+        provided historical data). With num_factors, the copula correlation
+        is modelled by that many principal components plus idiosyncratic
+        variance instead of a dense matrix
         """
         if len(self._historical_data) == 0:
             raise Exception('No historical data to calibrate to')
@@ -34,21 +38,39 @@ class GaussianCopula(AbstractModel):
         
         P = scipy.stats.norm.ppf(U)
         P = P.T[~np.isinf(P.T).any(axis=1)].T
-        self.copula_corr = np.corrcoef(P)
-        self.copula_corr_cholesky = np.linalg.cholesky(self.copula_corr).T
+        self.num_factors = num_factors
+        if num_factors is None:
+            self.copula_corr = np.corrcoef(P)
+            self.copula_corr_cholesky = np.linalg.cholesky(self.copula_corr).T
+            self.factor_loadings, self.idio_var = None, None
+        else:
+            self.copula_corr, self.copula_corr_cholesky = None, None
+            self.factor_loadings, self.idio_var = \
+                    self._factor_decomposition(P.T, num_factors, standardize=True)
         self.X0 = self._historical_data[self._securities].dropna().iloc[-1].values
+        self._iscalibrated = True
 
 
     def sample_gaussian_copula(self, num_steps):
         """
         Samples the calibrated Gaussian copula
         """
-        x = np.random.randn(self._num_securities, num_steps)
-        z = self.copula_corr_cholesky @ x
+        if self.num_factors is None:
+            x = np.random.randn(self._num_securities, num_steps)
+            z = self.copula_corr_cholesky @ x
+        else:
+            factors = np.random.randn(self.num_factors, num_steps)
+            idio = np.random.randn(self._num_securities, num_steps)
+            z = self.factor_loadings @ factors + idio*np.sqrt(self.idio_var)[:, None]
         u = scipy.stats.norm.cdf(z)
         return u
 
 
+    def _sample_logreturns(self, num_samples):
+        u = self.sample_gaussian_copula(num_samples)
+        return self._marginal_logreturns(u).T
+
+
     def simulate_jump(self, num_steps):
         sim_df = self.simulate_path(num_steps)
         endval = sim_df[self._securities].iloc[-1].values
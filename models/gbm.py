@@ -4,6 +4,8 @@ import pandas as pd
 
 
 class GBM(AbstractModel):
+    num_factors = None
+
     def __init__(self):
         pass
 
@@ -13,23 +15,80 @@ class GBM(AbstractModel):
         return 'gbm'
 
 
-    def calibrate(self):
+    def calibrate(self, num_factors=None):
         """
         Calibrate the model (i.e. fit model parameters to the
-        provided historical data)
+        provided historical data). With num_factors, the covariance of
+        the log-returns is modelled by that many principal components
+        plus idiosyncratic variance instead of a dense matrix, which
+        keeps calibration and sampling feasible for very many securities
         """
         if len(self._historical_data) == 0:
             raise Exception('No historical data to calibrate to')
         log_returns = self._historical_data[self._logret_columns]
+        self.num_factors = num_factors
+        X0 = self._historical_data[self._securities].dropna().iloc[-1].values
+        if num_factors is None:
+            self.calibrate_moments(log_returns.mean().values, log_returns.cov().values, X0)
+            return
         self.mu = log_returns.mean().values
-        self.cov = log_returns.cov().values
+        self.cov, self.cov_cholesky = None, None
+        self.factor_loadings, self.idio_var = self._factor_decomposition(log_returns, num_factors)
+        self.X0 = X0
+        self.params = {'mu':self.mu, 'cov':self.cov,'X0':self.X0, \
+                'factor_loadings':self.factor_loadings, 'idio_var':self.idio_var}
+
+        self._iscalibrated = True
+
+
+    def calibrate_moments(self, mu, cov, X0):
+        """
+        Calibrate the (dense) model directly from the mean and covariance
+        of the log-returns and the initial prices, e.g. when these are
+        maintained incrementally over a rolling window
+        """
+        self.mu = mu
+        self.num_factors = None
+        self.cov = cov
         self.cov_cholesky = np.linalg.cholesky(self.cov)
-        self.X0 = self._historical_data[self._securities].dropna().iloc[-1].values
+        self.factor_loadings, self.idio_var = None, None
+        self.X0 = X0
         self.params = {'mu':self.mu, 'cov':self.cov,'X0':self.X0}
 
         self._iscalibrated = True
 
 
+    def covariance(self, columns=None):
+        """
+        Returns the (dense) covariance matrix of the log-returns of the
+        securities at the given column indices (default: all of them)
+        """
+        if columns is None:
+            columns = np.arange(self._num_securities)
+        if self.num_factors is None:
+            return self.cov[np.ix_(columns, columns)]
+        B = self.factor_loadings[columns]
+        return B @ B.T + np.diag(self.idio_var[columns])
+
+
+    def _correlated_normals(self, num_steps):
+        """
+        Samples num_steps draws of zero-mean normals with the calibrated
+        covariance, shape (num_steps, num_securities). The factor model
+        costs O(N*k) per step instead of O(N^2)
+        """
+        if self.num_factors is None:
+            normals = np.random.randn(num_steps, self._num_securities)
+            return normals @ self.cov_cholesky.T
+        factors = np.random.randn(num_steps, self.num_factors)
+        idio = np.random.randn(num_steps, self._num_securities)
+        return factors @ self.factor_loadings.T + idio*np.sqrt(self.idio_var)
+
+
+    def _sample_logreturns(self, num_samples):
+        return self.mu + self._correlated_normals(num_samples)
+
+
     def simulate_jump(self, num_steps):
         """
         Simulate the security value only num_steps into the future
@@ -38,9 +97,8 @@ class GBM(AbstractModel):
         if not self._iscalibrated:
             raise Exception('Model must first be calibrated')
 
-        L = self.cov_cholesky
-        normal = np.random.randn(self._num_securities)
-        sim_logstep = self.mu*num_steps + np.sqrt(num_steps)*L @ normal
+        normal = self._correlated_normals(1)[0]
+        sim_logstep = self.mu*num_steps + np.sqrt(num_steps)*normal
         Xt = self.X0 * np.exp(sim_logstep)
         return Xt
 
@@ -52,10 +110,7 @@ class GBM(AbstractModel):
         if not self._iscalibrated:
             raise Exception('Model must first be calibrated')
 
-        L = self.cov_cholesky
-        normals = np.random.randn(num_steps, self._num_securities)
-        sim_logret = [self.mu + L @ normals[i] \
-                        for i in range(num_steps)]
+        sim_logret = self.mu + self._correlated_normals(num_steps)
         random_walk = np.cumsum(sim_logret, axis=0)
         gbm = self.X0 * np.exp(random_walk)
         
@@ -63,9 +118,3 @@ class GBM(AbstractModel):
             gbm = pd.DataFrame(gbm, columns=self._securities)
 
         return gbm
-
-
-
-
-
-
@@ -0,0 +1,94 @@
+from .abstractmodel import AbstractModel
+import numpy as np
+import pandas as pd
+
+
+class HistoricalSimulation(AbstractModel):
+    """
+    Historical simulation: each simulated step is a whole cross-sectional
+    row of historical log-returns, so the joint behaviour of the
+    securities is taken from the data as is. With block_length, rows are
+    drawn by the stationary bootstrap (runs of consecutive days with mean
+    length block_length) to keep short-range serial dependence. With
+    filtered, returns are standardized by an EWMA volatility and rescaled
+    to the current volatility (filtered historical simulation)
+    """
+    def __init__(self, block_length=None, filtered=False, decay=0.94):
+        self.block_length = block_length
+        self.filtered = filtered
+        self.decay = decay
+
+
+    @property
+    def name(self):
+        return 'historical'
+
+
+    def calibrate(self):
+        """
+        Prepares the historical log-return rows to sample from
+        """
+        if len(self._historical_data) == 0:
+            raise Exception('No historical data to calibrate to')
+        logrets = self._historical_data[self._logret_columns].dropna().to_numpy()
+        if len(logrets) < 2:
+            raise Exception('Need at least two historical log-returns to sample from')
+
+        if self.filtered:
+            # EWMA variance known before each day's return, and for tomorrow
+            var = np.empty(logrets.shape)
+            var[0] = logrets.var(axis=0)
+            for t in range(1, len(logrets)):
+                var[t] = self.decay*var[t-1] + (1-self.decay)*logrets[t-1]**2
+            current_var = self.decay*var[-1] + (1-self.decay)*logrets[-1]**2
+            self.current_vol = np.sqrt(current_var)
+            logrets = logrets / np.sqrt(var) * self.current_vol
+
+        self.logret_rows = logrets
+        self.X0 = self._historical_data[self._securities].dropna().iloc[-1].values
+        self._iscalibrated = True
+
+
+    def _sample_indices(self, num_steps, num_iter):
+        """
+        Row indices of shape (num_iter, num_steps): iid draws, or the
+        stationary bootstrap if a block length is set
+        """
+        T = len(self.logret_rows)
+        starts = np.random.randint(0, T, size=(num_iter, num_steps))
+        if self.block_length is None or num_steps == 1:
+            return starts
+        # a new block starts with probability 1/block_length, else the next day follows
+        restart = np.random.rand(num_iter, num_steps) < 1/self.block_length
+        restart[:, 0] = True
+        steps = np.arange(num_steps)
+        last_restart = np.maximum.accumulate(np.where(restart, steps, 0), axis=1)
+        rows = np.arange(num_iter)[:, None]
+        return (starts[rows, last_restart] + steps - last_restart) % T
+
+
+    def simulate_block(self, num_steps, num_iter):
+        """
+        Simulates num_iter paths at once with a single gather of
+        historical rows. Returns an array of shape (num_iter, num_steps,
+        num_securities)
+        """
+        if not self._iscalibrated:
+            raise Exception('Model must first be calibrated')
+        logrets = self.logret_rows[self._sample_indices(num_steps, num_iter)]
+        return self.X0 * np.exp(np.cumsum(logrets, axis=1))
+
+
+    def simulate_jump(self, num_steps):
+        return self.simulate_path(num_steps)[-1]
+
+
+    def simulate_path(self, num_steps, return_df=False):
+        """
+        Simulates stock movements by resampling historical log-return rows
+        """
+        walk = self.simulate_block(num_steps, 1)[0]
+        if return_df:
+            walk = pd.DataFrame(walk, columns=self._securities)
+
+        return walk
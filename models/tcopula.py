@@ -5,6 +5,8 @@ import scipy
 
 
 class TCopula(AbstractModel):
+    num_factors = None
+
     def __init__(self, dof):
         self.dof = dof
         
@@ -14,10 +16,14 @@ class TCopula(AbstractModel):
         return 't-copula'
 
 
-    def calibrate(self):
+    def calibrate(self, num_factors=None):
         """
         Calibrate the t copula (i.e. fit model parameters to the
-        provided historical data)
+        provided historical data). With num_factors, the copula correlation
+        is modelled by that many principal components plus idiosyncratic
+        variance instead of a dense matrix. The O(N^2) Kendall's tau
+        estimate is then replaced by the correlation of the normal scores
+        of the pseudo-observations, which the factors are fitted to
         """
         if len(self._historical_data) == 0:
             raise Exception('No historical data to calibrate to')
@@ -32,28 +38,51 @@ class TCopula(AbstractModel):
             pseudo_observations.append( ecdf(logrets) )
         U = np.array(pseudo_observations)
         
-        # Compute Kendall's tau correlation matrix
-        tau = np.empty([self._num_securities, self._num_securities])
-        for i in range(self._num_securities):
-            for j in range(self._num_securities):
-                tau_ij,p = scipy.stats.kendalltau(U[i], U[j])
-                tau[i,j] = tau_ij
-                    
-        self.copula_corr = np.sin(np.pi/2 * tau)
-        self.copula_corr_cholesky = np.linalg.cholesky(self.copula_corr).T
+        self.num_factors = num_factors
+        if num_factors is None:
+            # Compute Kendall's tau correlation matrix
+            tau = np.empty([self._num_securities, self._num_securities])
+            for i in range(self._num_securities):
+                for j in range(self._num_securities):
+                    tau_ij,p = scipy.stats.kendalltau(U[i], U[j])
+                    tau[i,j] = tau_ij
+                        
+            self.copula_corr = np.sin(np.pi/2 * tau)
+            self.copula_corr_cholesky = np.linalg.cholesky(self.copula_corr).T
+            self.factor_loadings, self.idio_var = None, None
+        else:
+            P = scipy.stats.norm.ppf(U)
+            P = P.T[~np.isinf(P.T).any(axis=1)]
+            self.copula_corr, self.copula_corr_cholesky = None, None
+            self.factor_loadings, self.idio_var = \
+                    self._factor_decomposition(P, num_factors, standardize=True)
         self.X0 = self._historical_data[self._securities].dropna().iloc[-1].values
+        self._iscalibrated = True
 
 
     def sample_t_copula(self, num_steps):
         """
         Samples the calibrated t copula
         """
-        t_dist = scipy.stats.multivariate_t(shape=self.copula_corr, df=self.dof)
-        t = t_dist.rvs(size=num_steps)
+        if self.num_factors is None:
+            t_dist = scipy.stats.multivariate_t(shape=self.copula_corr, df=self.dof)
+            t = t_dist.rvs(size=num_steps)
+        else:
+            # normal variance mixture: t = z / sqrt(W/dof) with W ~ chi2(dof)
+            factors = np.random.randn(num_steps, self.num_factors)
+            idio = np.random.randn(num_steps, self._num_securities)
+            z = factors @ self.factor_loadings.T + idio*np.sqrt(self.idio_var)
+            W = np.random.chisquare(self.dof, size=(num_steps, 1))
+            t = z / np.sqrt(W/self.dof)
         v = scipy.stats.t.cdf(t, df=self.dof)
         return v.T
 
 
+    def _sample_logreturns(self, num_samples):
+        u = self.sample_t_copula(num_samples)
+        return self._marginal_logreturns(u).T
+
+
     def simulate_jump(self, num_steps):
         sim_df = self.path_simulate(num_steps)
         endval = sim_df[self._securities].iloc[-1].values
@@ -2,3 +2,4 @@
 from .stock import Stock
 from .derivatives import Call,Put
 from .portfolio import Portfolio
+from .exposure import ExposureMatrix
@@ -1,15 +1,27 @@
 from abc import ABC, abstractmethod
+import numpy as np
 from .stock import Stock
+from .pricing import black_scholes
 
 
 class StockOption(ABC):
     """
-    Abstract class for stock options (puts, calls)
+    Abstract class for stock options (puts, calls).
+
+    Options given an expiry (in simulation time steps from today)
+    are marked to market with Black-Scholes before they expire, using
+    the risk-free rate and volatility per time step. Options without
+    an expiry are valued at their intrinsic value, as if expiring at
+    whatever horizon they are evaluated at.
     """
     _underlying = None
     _strike = None
     _premium = None
     _name = None
+    _kind = None
+    _expiry = None
+    _rate = 0.0
+    _volatility = None
     @property
     def underlying(self):
         if not isinstance(self._underlying, Stock):
@@ -21,42 +33,85 @@ class StockOption(ABC):
     @property
     def premium(self):
         return self._premium
+    @property
+    def expiry(self):
+        return self._expiry
+    @property
+    def rate(self):
+        return self._rate
+    @property
+    def volatility(self):
+        return self._volatility
 
-    @abstractmethod
-    def payoff(self, underlying_price):
-        pass
-
-
-
-class Call(StockOption):
-    def __init__(self, underlying, strike, premium):
+    def _setup(self, underlying, strike, premium, expiry, rate, volatility):
         if isinstance(underlying, str):
             underlying = Stock(underlying, 100)
+        if expiry is not None and volatility is None:
+            raise Exception('Options with an expiry need a volatility to be revalued')
         self._underlying = underlying
         self._strike = strike
         self._premium = premium
         self._name = underlying.name
+        self._expiry = expiry
+        self._rate = rate
+        self._volatility = volatility
 
     def payoff(self, underlying_price):
+        n = self._underlying._num_shares
+        return n*self.unit_payoff(underlying_price)
+
+    def value(self, underlying_price, elapsed):
+        """
+        Mark-to-market P&L after elapsed time steps
+        """
+        n = self._underlying._num_shares
+        return n*self.unit_value(underlying_price, elapsed)
+
+    def unit_value(self, underlying_price, elapsed):
+        """
+        Mark-to-market P&L per share of the underlying after elapsed
+        time steps (works elementwise on arrays)
+        """
+        if self._expiry is None:
+            return self.unit_payoff(underlying_price)
+        tau = self._expiry - np.asarray(elapsed)
+        price = black_scholes(underlying_price, self._strike, tau, \
+                        self._rate, self._volatility, self._kind)
+        return price - self._premium
+
+    @abstractmethod
+    def unit_payoff(self, underlying_price):
+        pass
+
+
+
+class Call(StockOption):
+    _kind = 'call'
+
+    def __init__(self, underlying, strike, premium, expiry=None, rate=0.0, volatility=None):
+        self._setup(underlying, strike, premium, expiry, rate, volatility)
+
+    def unit_payoff(self, underlying_price):
+        """
+        Payoff per share of the underlying (works elementwise on arrays)
+        """
         V = underlying_price
         K = self._strike
         P = self._premium
-        n = self._underlying._num_shares
-        return n*(max(V-K,0)-P)     
+        return np.maximum(V-K,0)-P
 
 
 class Put(StockOption):
-    def __init__(self, underlying, strike, premium):
-        if isinstance(underlying, str):
-            underlying = Stock(underlying, 100)
-        self._underlying = underlying
-        self._strike = strike
-        self._premium = premium
-        self._name = underlying.name
+    _kind = 'put'
 
-    def payoff(self, underlying_price):
+    def __init__(self, underlying, strike, premium, expiry=None, rate=0.0, volatility=None):
+        self._setup(underlying, strike, premium, expiry, rate, volatility)
+
+    def unit_payoff(self, underlying_price):
+        """
+        Payoff per share of the underlying (works elementwise on arrays)
+        """
         V = underlying_price
         K = self._strike
         P = self._premium
-        n = self._underlying._num_shares
-        return n*(max(K-V,0)-P)
+        return np.maximum(K-V,0)-P
@@ -0,0 +1,168 @@
+from .stock import Stock
+from .derivatives import StockOption
+from .pricing import black_scholes, black_scholes_greeks
+import numpy as np
+import pandas as pd
+
+
+class ExposureMatrix:
+    """
+    Compiles many portfolios ("books") into one instruments x books
+    exposure structure. Identical positions held by several books
+    share a single instrument row, so each instrument is only valued
+    once per scenario and the book P&Ls follow from one matrix product.
+    """
+    def __init__(self, portfolios, names=None):
+        if names is None:
+            names = [f'book-{i}' for i in range(len(portfolios))]
+        if len(names) != len(portfolios):
+            raise Exception('Need exactly one name per portfolio')
+        self.names = list(names)
+        self.instruments = []
+        self.securities = []
+        self._build(portfolios)
+
+
+    @property
+    def num_books(self):
+        return len(self.names)
+    @property
+    def num_instruments(self):
+        return len(self.instruments)
+
+
+    def _build(self, portfolios):
+        rows = {}
+        entries = []
+        for jj, portfolio in enumerate(portfolios):
+            for position in portfolio.positions:
+                if isinstance(position, Stock) and position._init_price is None:
+                    raise Exception(f'Stock position in {position._name} has no initial price')
+                key = self._instrument_key(position)
+                if key not in rows:
+                    rows[key] = len(self.instruments)
+                    self.instruments.append(position)
+                    self.securities.append(position._name)
+                entries.append((rows[key], jj, self._num_shares(position)))
+
+        weights = np.zeros((self.num_instruments, self.num_books))
+        for ii, jj, n in entries:
+            weights[ii, jj] += n
+        self.weights = weights
+
+        kinds = np.array([self._kind(position) for position in self.instruments])
+        self._stocks = np.flatnonzero(kinds == 'Stock')
+        self._calls = np.flatnonzero(kinds == 'Call')
+        self._puts = np.flatnonzero(kinds == 'Put')
+        self.init_prices = np.array([self._attr(p, '_init_price') for p in self.instruments], dtype=float)
+        self.strikes = np.array([self._attr(p, '_strike') for p in self.instruments], dtype=float)
+        self.premiums = np.array([self._attr(p, '_premium') for p in self.instruments], dtype=float)
+        self.expiries = np.array([self._attr(p, '_expiry') for p in self.instruments], dtype=float)
+        self.rates = np.array([self._attr(p, '_rate') for p in self.instruments], dtype=float)
+        self.volatilities = np.array([self._attr(p, '_volatility') for p in self.instruments], dtype=float)
+
+
+    def _kind(self, position):
+        if isinstance(position, Stock):
+            return 'Stock'
+        if isinstance(position, StockOption):
+            return position.__class__.__name__
+        raise Exception(f'Unsupported position type {type(position).__name__}')
+
+
+    def _instrument_key(self, position):
+        """
+        Positions with equal keys have the same per-share payoff
+        """
+        kind = self._kind(position)
+        if kind == 'Stock':
+            return (kind, position._name, position._init_price)
+        return (kind, position._name, position._strike, position._premium, \
+                    position._expiry, position._rate, position._volatility)
+
+
+    def _num_shares(self, position):
+        if isinstance(position, Stock):
+            return position._num_shares
+        return position._underlying._num_shares
+
+
+    def _attr(self, position, attr):
+        value = getattr(position, attr, None)
+        return np.nan if value is None else value
+
+
+    def columns_for(self, securities):
+        """
+        Returns the column of each instrument's underlying in a
+        cross section whose columns are the given securities
+        """
+        index = {sec:jj for jj,sec in enumerate(securities)}
+        missing = [sec for sec in self.securities if sec not in index]
+        if len(missing) != 0:
+            raise Exception(f'No simulated prices for {sorted(set(missing))}')
+        return np.array([index[sec] for sec in self.securities], dtype=int)
+
+
+    def unit_payoffs(self, prices, columns, elapsed=None):
+        """
+        Per-share P&L of every instrument in every scenario. prices has
+        shape (..., num_securities) and the result (..., num_instruments),
+        so a whole (iter, step) grid of cross sections is valued at once.
+
+        Without elapsed, options are valued at their payoff at expiry.
+        Otherwise options with an expiry are marked to market with
+        Black-Scholes after elapsed time steps; elapsed must broadcast
+        against prices.shape[:-1] (e.g. shape (1, num_steps) for a grid)
+        """
+        V = prices[..., columns]
+        U = np.empty(V.shape)
+        s, c, p = self._stocks, self._calls, self._puts
+        U[..., s] = V[..., s] - self.init_prices[s]
+        U[..., c] = np.maximum(V[..., c] - self.strikes[c], 0) - self.premiums[c]
+        U[..., p] = np.maximum(self.strikes[p] - V[..., p], 0) - self.premiums[p]
+
+        if elapsed is not None:
+            for kind, options in (('call', c), ('put', p)):
+                options = options[~np.isnan(self.expiries[options])]
+                if len(options) == 0:
+                    continue
+                tau = self.expiries[options] - np.asarray(elapsed, dtype=float)[..., None]
+                U[..., options] = black_scholes(V[..., options], self.strikes[options], tau, \
+                                    self.rates[options], self.volatilities[options], kind) \
+                                    - self.premiums[options]
+        return U
+
+
+    def unit_greeks(self, prices, columns, elapsed=None):
+        """
+        Per-share delta and gamma of every instrument with respect to
+        its underlying price, shapes as in unit_payoffs. Options without
+        an expiry (or without elapsed) have the delta of their payoff
+        """
+        V = prices[..., columns]
+        delta = np.zeros(V.shape)
+        gamma = np.zeros(V.shape)
+        delta[..., self._stocks] = 1.0
+        elapsed = np.inf if elapsed is None else elapsed
+        for kind, options in (('call', self._calls), ('put', self._puts)):
+            if len(options) == 0:
+                continue
+            tau = np.nan_to_num(self.expiries[options], nan=-np.inf) \
+                    - np.asarray(elapsed, dtype=float)[..., None]
+            delta[..., options], gamma[..., options] = black_scholes_greeks( \
+                    V[..., options], self.strikes[options], tau, \
+                    self.rates[options], self.volatilities[options], kind)
+        return delta, gamma
+
+
+    def payoffs(self, prices, securities, elapsed=None):
+        """
+        P&L of every book in every scenario, shape (..., num_books)
+        """
+        columns = self.columns_for(securities)
+        return self.unit_payoffs(prices, columns, elapsed) @ self.weights
+
+
+    def payoffs_df(self, prices, securities, elapsed=None):
+        return pd.DataFrame(self.payoffs(prices, securities, elapsed), columns=self.names)
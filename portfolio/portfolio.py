@@ -1,5 +1,4 @@
 from .derivatives import *
-from IPython.display import display
 import pandas as pd
 
 
@@ -24,21 +23,33 @@ class Portfolio:
         return sum(profits)
 
 
+    def value(self, prices, elapsed):
+        """
+        Mark-to-market P&L after elapsed time steps
+        """
+        profits = [position.value(price, elapsed) \
+                    for position,price in zip(self.positions,prices)]
+        return sum(profits)
+
+
     def payoff_sim(self, sim_df):
         profits = [self.payoff(sim_df.iloc[i]) for i in range(len(sim_df))]
         return profits
 
 
     def summary(self):
+        from IPython.display import display
+
         derivatives = [position for position in self.positions if isinstance(position,StockOption)]
         non_derivatives = [position for position in self.positions if position not in derivatives]
         
-        deriv_dict = {'Type':[], 'Underlying':[], 'Strike':[], 'Premium':[], 'Shares':[]}
+        deriv_dict = {'Type':[], 'Underlying':[], 'Strike':[], 'Premium':[], 'Expiry':[], 'Shares':[]}
         for deriv in derivatives:
             deriv_dict['Type'].append(deriv.__class__.__name__)
             deriv_dict['Underlying'].append(deriv.underlying.name)
             deriv_dict['Strike'].append(deriv.strike)
             deriv_dict['Premium'].append(deriv.premium)
+            deriv_dict['Expiry'].append(deriv.expiry)
             deriv_dict['Shares'].append(deriv._underlying._num_shares)
 
         nonderiv_dict = {'Stock':[], 'Shares':[], 'Initial Price':[]}
@@ -0,0 +1,59 @@
+import numpy as np
+import scipy
+
+
+def _d1_d2(S, K, tau, r, sigma):
+    """
+    The Black-Scholes d1 and d2 terms. tau must be positive
+    """
+    vol = sigma*np.sqrt(tau)
+    d1 = (np.log(S/K) + (r + sigma**2/2)*tau) / vol
+    return d1, d1 - vol
+
+
+def black_scholes(S, K, tau, r, sigma, kind='call'):
+    """
+    Black-Scholes price of a European call or put. All arguments
+    broadcast against each other, so a whole grid of scenarios and
+    times is priced in one call. tau, r and sigma are in the units of
+    the simulation time step. Where tau <= 0 the intrinsic value is
+    returned
+    """
+    S, K, tau, r, sigma = np.broadcast_arrays(*[np.asarray(x, dtype=float) \
+                                                for x in (S, K, tau, r, sigma)])
+    live = tau > 0
+    price = np.maximum(S-K, 0) if kind == 'call' else np.maximum(K-S, 0)
+    price = np.array(price, dtype=float)
+    if live.any():
+        S, K, tau, r, sigma = S[live], K[live], tau[live], r[live], sigma[live]
+        d1, d2 = _d1_d2(S, K, tau, r, sigma)
+        discount = K*np.exp(-r*tau)
+        N = scipy.special.ndtr
+        if kind == 'call':
+            price[live] = S*N(d1) - discount*N(d2)
+        else:
+            price[live] = discount*N(-d2) - S*N(-d1)
+    return price[()]
+
+
+def black_scholes_greeks(S, K, tau, r, sigma, kind='call'):
+    """
+    Black-Scholes delta and gamma of a European call or put, broadcast
+    like black_scholes. Where tau <= 0 the delta of the payoff at
+    expiry is returned and gamma is zero
+    """
+    S, K, tau, r, sigma = np.broadcast_arrays(*[np.asarray(x, dtype=float) \
+                                                for x in (S, K, tau, r, sigma)])
+    live = tau > 0
+    if kind == 'call':
+        delta = np.where(S > K, 1.0, 0.0)
+    else:
+        delta = np.where(S < K, -1.0, 0.0)
+    gamma = np.zeros(S.shape)
+    if live.any():
+        S, K, tau, r, sigma = S[live], K[live], tau[live], r[live], sigma[live]
+        d1, d2 = _d1_d2(S, K, tau, r, sigma)
+        N = scipy.special.ndtr
+        delta[live] = N(d1) if kind == 'call' else N(d1) - 1
+        gamma[live] = scipy.stats.norm.pdf(d1) / (S*sigma*np.sqrt(tau))
+    return delta[()], gamma[()]
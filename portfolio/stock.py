@@ -16,4 +16,19 @@ class Stock:
         return self._init_price
 
     def payoff(self, price):
-        return self._num_shares*(price - self._init_price)
\ No newline at end of file
+        return self._num_shares*self.unit_payoff(price)
+
+    def unit_payoff(self, price):
+        """
+        Payoff of a single share (works elementwise on arrays)
+        """
+        return price - self._init_price
+
+    def value(self, price, elapsed):
+        return self._num_shares*self.unit_value(price, elapsed)
+
+    def unit_value(self, price, elapsed):
+        """
+        Mark-to-market P&L of a single share; elapsed time does not matter
+        """
+        return self.unit_payoff(price)
@@ -14,6 +14,7 @@ def main():
 
     app = RiskyAppBuilder(datadir)
     curdoc().add_root(app.complete_layout)
+    curdoc().on_session_destroyed(lambda session_context: app.close())
     curdoc().title = 'risky'
     output_file('riskyapp.html')
 
@@ -13,6 +13,7 @@ from bokeh.models import (
 import sys
 sys.path.append("..")
 from risky.analysis import Analysis
+from risky.analysis.cache import shared_cache
 
 SIDEBAR_HEIGHT = 300
 
@@ -82,10 +83,21 @@ class RiskyAppBuilder:
         if attr != '':
             self.analyze_button.disabled = False
         filepath = self.datadir + self.fileinput.filename
-        self.analysis = Analysis(filepath)
+        # sessions share the opened simulation through the process-wide cache
+        self.close()
+        self.analysis = Analysis(filepath, cache=shared_cache)
         self._update_sidebar_text()
 
 
+    def close(self):
+        """
+        Releases this session's simulation; called when the session ends
+        """
+        if self.analysis is not None:
+            self.analysis.close()
+            self.analysis = None
+
+
 
     def _callback_on_create_analysis(self):
         pass